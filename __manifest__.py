@@ -19,7 +19,7 @@
 ##############################################################################
 {
     'name': 'Account Invoice Currency',
-    'version': '13.0.1.2.0',
+    'version': '13.0.1.3.0',
     'category': 'Accounting',
     'license': 'AGPL-3',
     'depends': [
@@ -28,6 +28,7 @@
         'l10n_ar',
     ],
     'data': [
+        'data/ir_cron.xml',
         'views/account_view.xml',
     ],
     'demo': [
@@ -3,14 +3,200 @@
 # directory
 ##############################################################################
 from odoo import api, models, fields, _
-from odoo.exceptions import ValidationError
+from odoo.exceptions import ValidationError, UserError
 from odoo.tools.misc import formatLang, format_date, get_lang
+import logging
+import threading
+import weakref
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict
 from datetime import date
 from odoo.tools import float_is_zero, float_compare, safe_eval, date_utils, email_split, email_escape_char, email_re
 
+_logger = logging.getLogger(__name__)
+
+
+class CurrencyRateCache(object):
+    ''' Size-bounded store of the currency rates preloaded by 'res.currency._preload_rates'.
+
+    The rates are kept per (currency_id, company_id) series, company_id being False for the rates shared by all
+    companies, as two compact arrays of date ordinals / rates. The least recently used series are evicted once
+    more than 'max_size' rates are stored, 'evicted' counting them. 'max_size' is a soft bound: a series is never
+    split, so the last series added is kept even when it alone holds more than 'max_size' rates. Lookups outside of
+    [date_from, date_to] or on an evicted series return None so the caller falls back to the database.
+    '''
+
+    def __init__(self, date_from, date_to, max_size=100000):
+        self.date_from = date_from.toordinal()
+        self.date_to = date_to.toordinal()
+        self.max_size = max_size
+        self.size = 0
+        self.evicted = 0
+        self._series = OrderedDict()
+
+    def add_series(self, currency_id, company_id, dates, rates):
+        ''' Store the rates of a series.
+        :param dates: The date ordinals of the rates, sorted, as an array('l').
+        :param rates: The rates as an array('d').
+        '''
+        key = (currency_id, company_id or False)
+        if key in self._series:
+            self.size -= len(self._series.pop(key)[0])
+        self._series[key] = (dates, rates)
+        self.size += len(dates)
+        while self.size > self.max_size and len(self._series) > 1:
+            self.size -= len(self._series.popitem(last=False)[1][0])
+            self.evicted += 1
+
+    def _lookup(self, key, ordinal):
+        series = self._series.get(key)
+        if series is None:
+            return None
+        self._series.move_to_end(key)
+        dates, rates = series
+        index = bisect_right(dates, ordinal)
+        return rates[index - 1] if index else False
+
+    def get_rate(self, currency_id, company_id, rate_date):
+        ''' Return the rate of a currency like 'res.currency._get_rates' does: the latest company specific rate if
+        any, else the latest shared rate, else 1.0.
+        :return: The rate or None if it is not available in the cache.
+        '''
+        ordinal = rate_date.toordinal()
+        if not self.date_from <= ordinal <= self.date_to:
+            return None
+        rate = self._lookup((currency_id, company_id), ordinal)
+        if rate is None:
+            return None
+        if rate is False:
+            rate = self._lookup((currency_id, False), ordinal)
+            if rate is None:
+                return None
+        return rate or 1.0
+
+    def get_conversion_rate(self, from_currency, to_currency, company, rate_date):
+        ''' Cached equivalent of 'res.currency._get_conversion_rate'.
+        :return: The conversion rate or None if it is not available in the cache.
+        '''
+        from_rate = self.get_rate(from_currency.id, company.id, rate_date)
+        to_rate = self.get_rate(to_currency.id, company.id, rate_date)
+        if from_rate is None or to_rate is None:
+            return None
+        return to_rate / from_rate
+
+
+# The preloaded rates, per database cursor. '_preload_rates' drops them on the next commit or rollback of the
+# cursor, the rollback of a savepoint does not.
+_rate_caches = weakref.WeakKeyDictionary()
+
+
 class ResCurrency(models.Model):
     _inherit = 'res.currency'
 
+    @api.model
+    def _preload_rates(self, companies, currencies, date_from, date_to, max_size=100000, page_size=1000):
+        ''' Preload the rates of some currencies for some companies and a date range in a size-bounded cache.
+        The cache is registered on the current cursor and the conversions of this module read from it until the
+        cursor is committed or rolled back, or '_clear_preloaded_rates' is called. Batch jobs committing every N
+        records must preload again after each commit, e.g.:
+
+            self.env['res.currency']._preload_rates(companies, currencies, date_from, date_to)
+            moves._recompute_dynamic_lines(recompute_all_taxes=True)
+
+        The rates created or modified afterwards in the same transaction, or rolled back to a savepoint, are not
+        seen by the cache. The rates are read by pages of 'page_size' rows so the memory used while loading is
+        bounded by 'max_size' (see CurrencyRateCache) plus one page. A warning is logged when the rates of the
+        range do not fit in 'max_size'.
+
+        :param companies:   The res.company records.
+        :param currencies:  The res.currency records, the companies' currencies are always added.
+        :param date_from:   The first date to convert at.
+        :param date_to:     The last date to convert at.
+        :param max_size:    The maximum number of rates to keep.
+        :param page_size:   The number of rates read per query.
+        :return:            The CurrencyRateCache.
+        '''
+        date_from = fields.Date.to_date(date_from)
+        date_to = fields.Date.to_date(date_to)
+        if date_from > date_to:
+            raise UserError(_("The start date of the rates to preload must be before the end date."))
+        currencies |= companies.mapped('currency_id')
+        cache = CurrencyRateCache(date_from, date_to, max_size=max_size)
+        cr = self._cr
+        _rate_caches[cr] = cache
+        cr.after('commit', lambda: _rate_caches.pop(cr, None))
+        cr.after('rollback', lambda: _rate_caches.pop(cr, None))
+        if not currencies or not companies:
+            return cache
+        self.env['res.currency.rate'].flush(['rate', 'currency_id', 'company_id', 'name'])
+        # The rates of the range and, for each series, the last rate before it, read by pages sorted by series and
+        # resumed after the last row read (keyset pagination) as a client side cursor fetches all the rows at once.
+        query = """SELECT id, currency_id, company_id, name, rate FROM (
+                       (SELECT id, currency_id, company_id, name, rate FROM res_currency_rate
+                         WHERE currency_id IN %s AND (company_id IS NULL OR company_id IN %s) AND name >= %s AND name <= %s)
+                       UNION ALL
+                       (SELECT DISTINCT ON (currency_id, company_id) id, currency_id, company_id, name, rate FROM res_currency_rate
+                         WHERE currency_id IN %s AND (company_id IS NULL OR company_id IN %s) AND name < %s
+                         ORDER BY currency_id, company_id, name DESC)
+                   ) AS r
+                   WHERE (currency_id, COALESCE(company_id, 0), name, id) > (%s, %s, %s, %s)
+                   ORDER BY currency_id, COALESCE(company_id, 0), name, id
+                   LIMIT %s"""
+        params = (tuple(currencies.ids), tuple(companies.ids))
+        params = params + (date_from, date_to) + params + (date_from,)
+
+        # Only the series being read is held outside of the cache.
+        loaded_keys = set()
+        total_size = 0
+        key = dates = rates = None
+        last_row = (0, 0, date.min, 0)
+        while True:
+            self._cr.execute(query, params + last_row + (page_size,))
+            rows = self._cr.fetchall()
+            for rate_id, currency_id, company_id, rate_date, rate in rows:
+                row_key = (currency_id, company_id or False)
+                if row_key != key:
+                    if key:
+                        cache.add_series(key[0], key[1], dates, rates)
+                    key, dates, rates = row_key, array('l'), array('d')
+                    loaded_keys.add(key)
+                dates.append(rate_date.toordinal())
+                rates.append(rate)
+                total_size += 1
+            if len(rows) < page_size:
+                break
+            rate_id, currency_id, company_id, rate_date, rate = rows[-1]
+            last_row = (currency_id, company_id or 0, rate_date, rate_id)
+        if key:
+            cache.add_series(key[0], key[1], dates, rates)
+
+        # Remember the series without any rate so their lookups don't fall back to the database.
+        for currency in currencies:
+            for company_id in [False] + companies.ids:
+                if (currency.id, company_id) not in loaded_keys:
+                    cache.add_series(currency.id, company_id, array('l'), array('d'))
+
+        if cache.evicted:
+            _logger.warning("The %s currency rates to preload exceed the maximum size of %s, %s series have been "
+                            "evicted and will be read from the database.", total_size, max_size, cache.evicted)
+        return cache
+
+    @api.model
+    def _clear_preloaded_rates(self):
+        ''' Drop the rates preloaded by '_preload_rates' for the current cursor. '''
+        _rate_caches.pop(self._cr, None)
+
+    @api.model
+    def _get_cached_conversion_rate(self, from_currency, to_currency, company, date):
+        ''' Same as '_get_conversion_rate' but reading from the rates preloaded by '_preload_rates' if any. '''
+        cache = _rate_caches.get(self._cr)
+        if cache is not None:
+            rate = cache.get_conversion_rate(from_currency, to_currency, company, fields.Date.to_date(date))
+            if rate is not None:
+                return rate
+        return self._get_conversion_rate(from_currency, to_currency, company, date)
+
     def _convert(self, from_amount, to_currency, company, date, round=True, new_rate=0):
         """Returns the converted amount of ``from_amount``` from the currency
            ``self`` to the currency ``to_currency`` for the given ``date`` and
@@ -30,7 +216,7 @@ class ResCurrency(models.Model):
             to_amount = from_amount
         else:
             if new_rate == 0:
-                to_amount = from_amount * self._get_conversion_rate(self, to_currency, company, date)
+                to_amount = from_amount * self._get_cached_conversion_rate(self, to_currency, company, date)
             else:
                 to_amount = from_amount * new_rate
             #to_amount = from_amount * 75
@@ -41,7 +227,123 @@ class AccountMove(models.Model):
     _inherit = 'account.move'
 
     purchase_currency_rate = fields.Float('Tipo de cambio compras')
+    totals_pending = fields.Boolean('Totales pendientes', readonly=True, copy=False,
+        help="The taxes and cash rounding of this bill are being recomputed in background.")
+    totals_recompute_failed = fields.Boolean('Error al recalcular totales', readonly=True, copy=False,
+        help="The background recomputation of the taxes and cash rounding of this bill failed. Save the bill again to retry.")
+
+    def _get_effective_currency_rate(self):
+        ''' Return the manual rate to use when converting the amounts of this move, 0 when the currency rate applies.
+        :return: The 'purchase_currency_rate' of vendor bills/refunds having one, 0.0 otherwise.
+        '''
+        self.ensure_one()
+        if self.type in ['in_invoice','in_refund'] and self.purchase_currency_rate > 0:
+            return self.purchase_currency_rate
+        return 0.0
+
+    @api.model
+    def _get_async_recompute_threshold(self):
+        ''' Return the number of lines from which the taxes / cash rounding of a saved draft bill are recomputed in
+        background. The feature is disabled (0) unless the 'account_invoice_currency.async_recompute_threshold'
+        system parameter is set to a positive integer and the 'Account: recompute pending bill totals' cron is active.
+        '''
+        param = self.env['ir.config_parameter'].sudo().get_param('account_invoice_currency.async_recompute_threshold')
+        try:
+            threshold = int(param or 0)
+        except (TypeError, ValueError):
+            _logger.warning("Invalid value %r for 'account_invoice_currency.async_recompute_threshold', an integer is expected.", param)
+            return 0
+        if threshold <= 0:
+            return 0
+        cron = self.env.ref('account_invoice_currency.ir_cron_recompute_pending_totals', raise_if_not_found=False)
+        if not cron or not cron.sudo().active:
+            return 0
+        return threshold
+
+    def _queue_totals_recompute(self):
+        ''' Defer the taxes / cash rounding recomputation of a large draft bill to the background job.
+        Only bills already saved and having at least as many lines as '_get_async_recompute_threshold' are deferred.
+        The flag is only set on the current record: in an onchange, it is displayed in the form and the bill is
+        queued by 'write' when the lines are saved.
+        :return: True if the recomputation has been deferred, False if it must be done now.
+        '''
+        self.ensure_one()
+        if self.env.context.get('totals_recompute_job'):
+            return False
+        if not self._origin or self.state != 'draft' or not self.is_invoice(include_receipts=True):
+            return False
+        threshold = self._get_async_recompute_threshold()
+        if not threshold or len(self.line_ids) < threshold:
+            return False
+        if not self.totals_pending or self.totals_recompute_failed:
+            self.update({'totals_pending': True, 'totals_recompute_failed': False})
+        return True
+
+    @api.model
+    def _get_totals_recompute_trigger_fields(self):
+        ''' Return the fields whose change triggers '_recompute_dynamic_lines' (through the lines or the onchanges)
+        and therefore queues a bill above the threshold when saved.
+        '''
+        return ['line_ids', 'invoice_line_ids', 'invoice_cash_rounding_id', 'invoice_payment_term_id', 'currency_id',
+                'date', 'purchase_currency_rate']
+
+    def write(self, vals):
+        res = super(AccountMove, self).write(vals)
+        trigger_fields = self._get_totals_recompute_trigger_fields()
+        if any(field in vals for field in trigger_fields) and not self.env.context.get('totals_recompute_job'):
+            threshold = self._get_async_recompute_threshold()
+            to_queue = threshold and self.filtered(lambda move: move.state == 'draft'
+                                                   and move.is_invoice(include_receipts=True)
+                                                   and len(move.line_ids) >= threshold
+                                                   and (not move.totals_pending or move.totals_recompute_failed))
+            if to_queue:
+                to_queue.write({'totals_pending': True, 'totals_recompute_failed': False})
+        return res
 
+    @api.model
+    def _cron_recompute_pending_totals(self, limit=10):
+        ''' Recompute the taxes and cash rounding of the bills queued by 'write'. A bill failing to be recomputed
+        is flagged with 'totals_recompute_failed' and left out of the queue until its lines are saved again.
+        '''
+        moves = self.search([('totals_pending', '=', True), ('totals_recompute_failed', '=', False)], limit=limit)
+        for move in moves:
+            try:
+                with self.env.cr.savepoint():
+                    if move.state == 'draft':
+                        job_move = move.with_context(totals_recompute_job=True, check_move_validity=False)
+                        job_move._recompute_dynamic_lines(recompute_all_taxes=True)
+                        job_move._check_balanced()
+                    move.with_context(totals_recompute_job=True).totals_pending = False
+                    move.flush()
+            except Exception:
+                _logger.exception("Failed to recompute the totals of %s (id %s).", move.display_name, move.id)
+                # Drop the values of the rolled back savepoint still in cache.
+                self.env.clear()
+                move.totals_recompute_failed = True
+            # Commit after each bill to not lose the work already done on large batches.
+            if not getattr(threading.currentThread(), 'testing', False):
+                self.env.cr.commit()
+
+    def post(self):
+        for move in self:
+            if move.totals_recompute_failed:
+                raise UserError(_("The totals of %s could not be recomputed, please check its lines and save it again.") % move.display_name)
+            if move.totals_pending:
+                raise UserError(_("The totals of %s are still being recomputed, please try again in a few minutes.") % move.display_name)
+        return super(AccountMove, self).post()
+
+    @api.model
+    def _autopost_draft_entries(self):
+        ''' Same as the original cron but leaving aside the bills whose totals are pending, they are posted by a
+        later run once recomputed instead of blocking the other entries.
+        '''
+        records = self.search([
+            ('state', '=', 'draft'),
+            ('date', '<=', fields.Date.today()),
+            ('auto_post', '=', True),
+            ('totals_pending', '=', False),
+        ])
+        records.post()
 
     def _recompute_tax_lines(self, recompute_tax_base_amount=False):
         ''' Compute the dynamic tax lines of the journal entry.
@@ -53,14 +355,34 @@ class AccountMove(models.Model):
             * rounding_lines: The cash rounding lines of the invoice.
         '''
         self.ensure_one()
+        if self._queue_totals_recompute():
+            return
         in_draft_mode = self != self._origin
 
+        def _freeze_grouping_value(value):
+            ''' Make a grouping value hashable, e.g. the x2many commands used for 'tax_ids' / 'tag_ids'. '''
+            if isinstance(value, (list, tuple)):
+                return tuple(_freeze_grouping_value(v) for v in value)
+            return value
+
         def _serialize_tax_grouping_key(grouping_dict):
             ''' Serialize the dictionary values to be used in the taxes_map.
             :param grouping_dict: The values returned by '_get_tax_grouping_key_from_tax_line' or '_get_tax_grouping_key_from_base_line'.
-            :return: A string representing the values.
+            :return: A tuple representing the values.
             '''
-            return '-'.join(str(v) for v in grouping_dict.values())
+            return tuple(_freeze_grouping_value(v) for v in grouping_dict.values())
+
+        repartition_line_taxes = {}
+
+        def _get_repartition_line_tax(tax_repartition_line_id):
+            ''' Get the tax owning a repartition line, resolved only once per repartition line and move.
+            :param tax_repartition_line_id: The id of an account.tax.repartition.line.
+            :return: The account.tax record.
+            '''
+            if tax_repartition_line_id not in repartition_line_taxes:
+                tax_repartition_line = self.env['account.tax.repartition.line'].browse(tax_repartition_line_id)
+                repartition_line_taxes[tax_repartition_line_id] = tax_repartition_line.invoice_tax_id or tax_repartition_line.refund_tax_id
+            return repartition_line_taxes[tax_repartition_line_id]
 
         def _compute_base_line_taxes(base_line):
             ''' Compute taxes amounts both in company currency / foreign currency as the ratio between
@@ -160,8 +482,7 @@ class AccountMove(models.Model):
                 grouping_dict = self._get_tax_grouping_key_from_base_line(line, tax_vals)
                 grouping_key = _serialize_tax_grouping_key(grouping_dict)
 
-                tax_repartition_line = self.env['account.tax.repartition.line'].browse(tax_vals['tax_repartition_line_id'])
-                tax = tax_repartition_line.invoice_tax_id or tax_repartition_line.refund_tax_id
+                tax = _get_repartition_line_tax(tax_vals['tax_repartition_line_id'])
 
                 if tax.tax_exigibility == 'on_payment':
                     tax_exigible = False
@@ -204,9 +525,7 @@ class AccountMove(models.Model):
                 })
             else:
                 create_method = in_draft_mode and self.env['account.move.line'].new or self.env['account.move.line'].create
-                tax_repartition_line_id = taxes_map_entry['grouping_dict']['tax_repartition_line_id']
-                tax_repartition_line = self.env['account.tax.repartition.line'].browse(tax_repartition_line_id)
-                tax = tax_repartition_line.invoice_tax_id or tax_repartition_line.refund_tax_id
+                tax = _get_repartition_line_tax(taxes_map_entry['grouping_dict']['tax_repartition_line_id'])
                 tax_line = create_method({
                     'name': tax.name,
                     'move_id': self.id,
@@ -243,13 +562,16 @@ class AccountMove(models.Model):
         having the biggest balance.
         '''
         self.ensure_one()
+        if self._queue_totals_recompute():
+            return
         in_draft_mode = self != self._origin
 
-        def _compute_cash_rounding(self, total_balance, total_amount_currency):
+        def _compute_cash_rounding(self, total_balance, total_amount_currency, effective_rate):
             ''' Compute the amount differences due to the cash rounding.
             :param self:                    The current account.move record.
             :param total_balance:           The invoice's total in company's currency.
             :param total_amount_currency:   The invoice's total in invoice's currency.
+            :param effective_rate:          The rate returned by '_get_effective_currency_rate'.
             :return:                        The amount differences both in company's currency & invoice's currency.
             '''
             if self.currency_id == self.company_id.currency_id:
@@ -257,18 +579,16 @@ class AccountMove(models.Model):
                 diff_amount_currency = 0.0
             else:
                 diff_amount_currency = self.invoice_cash_rounding_id.compute_difference(self.currency_id, total_amount_currency)
-                if self.type in ['in_invoice','in_refund'] and self.purchase_currency_rate > 0:
-                    diff_balance = self.currency_id._convert(diff_amount_currency, self.company_id.currency_id, self.company_id, self.date, True, self.purchase_currency_rate)
-                else:
-                    diff_balance = self.currency_id._convert(diff_amount_currency, self.company_id.currency_id, self.company_id, self.date)
+                diff_balance = self.currency_id._convert(diff_amount_currency, self.company_id.currency_id, self.company_id, self.date, True, effective_rate)
             return diff_balance, diff_amount_currency
 
-        def _apply_cash_rounding(self, diff_balance, diff_amount_currency, cash_rounding_line):
+        def _apply_cash_rounding(self, diff_balance, diff_amount_currency, cash_rounding_line, biggest_tax_line):
             ''' Apply the cash rounding.
             :param self:                    The current account.move record.
             :param diff_balance:            The computed balance to set on the new rounding line.
             :param diff_amount_currency:    The computed amount in invoice's currency to set on the new rounding line.
             :param cash_rounding_line:      The existing cash rounding line.
+            :param biggest_tax_line:        The tax line having the biggest subtotal, if any.
             :return:                        The newly created rounding line.
             '''
             rounding_line_vals = {
@@ -286,11 +606,6 @@ class AccountMove(models.Model):
             }
 
             if self.invoice_cash_rounding_id.strategy == 'biggest_tax':
-                biggest_tax_line = None
-                for tax_line in self.line_ids.filtered('tax_repartition_line_id'):
-                    if not biggest_tax_line or tax_line.price_subtotal > biggest_tax_line.price_subtotal:
-                        biggest_tax_line = tax_line
-
                 # No tax found.
                 if not biggest_tax_line:
                     return
@@ -345,19 +660,34 @@ class AccountMove(models.Model):
                 self.line_ids -= existing_cash_rounding_line
                 existing_cash_rounding_line = self.env['account.move.line']
 
-        others_lines = self.line_ids.filtered(lambda line: line.account_id.user_type_id.type not in ('receivable', 'payable'))
-        others_lines -= existing_cash_rounding_line
-        total_balance = sum(others_lines.mapped('balance'))
-        total_amount_currency = sum(others_lines.mapped('amount_currency'))
+        # Compute the totals and find the biggest tax line in a single pass over the lines. The account types are
+        # read once per account instead of once per line.
+        track_biggest_tax = self.invoice_cash_rounding_id.strategy == 'biggest_tax'
+        excluded_accounts = set(account for account in self.line_ids.mapped('account_id')
+                                if account.user_type_id.type in ('receivable', 'payable'))
+        total_balance = 0.0
+        total_amount_currency = 0.0
+        biggest_tax_line = None
+        biggest_tax_subtotal = 0.0
+        for line in self.line_ids:
+            if track_biggest_tax and line.tax_repartition_line_id:
+                price_subtotal = line.price_subtotal
+                if not biggest_tax_line or price_subtotal > biggest_tax_subtotal:
+                    biggest_tax_line = line
+                    biggest_tax_subtotal = price_subtotal
+            if line.account_id in excluded_accounts or line in existing_cash_rounding_line:
+                continue
+            total_balance += line.balance
+            total_amount_currency += line.amount_currency
 
-        diff_balance, diff_amount_currency = _compute_cash_rounding(self, total_balance, total_amount_currency)
+        diff_balance, diff_amount_currency = _compute_cash_rounding(self, total_balance, total_amount_currency, self._get_effective_currency_rate())
 
         # The invoice is already rounded.
         if self.currency_id.is_zero(diff_balance) and self.currency_id.is_zero(diff_amount_currency):
             self.line_ids -= existing_cash_rounding_line
             return
 
-        _apply_cash_rounding(self, diff_balance, diff_amount_currency, existing_cash_rounding_line)
+        _apply_cash_rounding(self, diff_balance, diff_amount_currency, existing_cash_rounding_line, biggest_tax_line)
 
 
 
@@ -537,6 +867,25 @@ class AccountMoveLine(models.Model):
         else:
             self.price_unit = company.currency_id._convert(price_unit, self.move_id.currency_id, company, self.move_id.date)
 
+    @api.onchange('quantity', 'discount', 'price_unit', 'tax_ids')
+    def _onchange_price_subtotal(self):
+        lines = self.filtered(lambda line: line.move_id.is_invoice(include_receipts=True))
+        for line in lines:
+            line.update(line._get_price_total_and_subtotal())
+
+        # Convert all the subtotals at once instead of calling '_get_fields_onchange_subtotal' line per line.
+        effective_rates = {move: move._get_effective_currency_rate() for move in lines.mapped('move_id')}
+        accounting_vals_list = self._get_fields_onchange_subtotal_model_batch(
+            [line.price_subtotal for line in lines],
+            [line.move_id.type for line in lines],
+            [line.currency_id for line in lines],
+            [line.move_id.company_id for line in lines],
+            [line.move_id.date for line in lines],
+            [effective_rates[line.move_id] for line in lines],
+        )
+        for line, accounting_vals in zip(lines, accounting_vals_list):
+            line.update(accounting_vals)
+
     def _recompute_debit_credit_from_amount_currency(self):
         for line in self:
             # Recompute the debit/credit based on amount_currency/currency_id and date.
@@ -673,30 +1022,56 @@ class AccountMoveLine(models.Model):
         :param date:            The move's date.
         :return:                A dictionary containing 'debit', 'credit', 'amount_currency'.
         '''
-        if move_type in self.move_id.get_outbound_types():
-            sign = 1
-        elif move_type in self.move_id.get_inbound_types():
-            sign = -1
-        else:
-            sign = 1
-        price_subtotal *= sign
+        move = self.move_id[:1]
+        rate = move._get_effective_currency_rate() if move else 0.0
+        return self._get_fields_onchange_subtotal_model_batch([price_subtotal], [move_type], [currency], [company], [date], [rate])[0]
 
-        if currency and currency != company.currency_id:
-            # Multi-currencies.
-            if self.move_id.type in ['in_invoice','in_refund'] and self.move_id.purchase_currency_rate > 0:
-                balance = currency._convert(price_subtotal, company.currency_id, company, date, True, self.move_id.purchase_currency_rate)
+    @api.model
+    def _get_fields_onchange_subtotal_model_batch(self, price_subtotals, move_types, currencies, companies, dates, rates):
+        ''' Batch version of '_get_fields_onchange_subtotal_model' converting many subtotals in a single pass.
+        The conversion rate is resolved only once per (currency, company, date) triplet.
+
+        :param price_subtotals: The untaxed amounts.
+        :param move_types:      The types of the moves.
+        :param currencies:      The lines' currencies.
+        :param companies:       The moves' companies.
+        :param dates:           The moves' dates.
+        :param rates:           The moves' rates as returned by '_get_effective_currency_rate', 0 to use the currency rate.
+        :return:                A list of dictionaries containing 'debit', 'credit', 'amount_currency'.
+        '''
+        outbound_types = self.env['account.move'].get_outbound_types()
+        inbound_types = self.env['account.move'].get_inbound_types()
+        rates_cache = {}
+        res = []
+        for price_subtotal, move_type, currency, company, date, rate in zip(price_subtotals, move_types, currencies, companies, dates, rates):
+            if move_type in outbound_types:
+                sign = 1
+            elif move_type in inbound_types:
+                sign = -1
             else:
-                balance = currency._convert(price_subtotal, company.currency_id, company, date)
-            return {
-                'amount_currency': price_subtotal,
-                'debit': balance > 0.0 and balance or 0.0,
-                'credit': balance < 0.0 and -balance or 0.0,
-            }
-        else:
-            # Single-currency.
-            return {
-                'amount_currency': 0.0,
-                'debit': price_subtotal > 0.0 and price_subtotal or 0.0,
-                'credit': price_subtotal < 0.0 and -price_subtotal or 0.0,
-            }
+                sign = 1
+            price_subtotal *= sign
+
+            company_currency = company.currency_id
+            if currency and currency != company_currency:
+                # Multi-currencies.
+                if not rate:
+                    key = (currency.id, company.id, date)
+                    if key not in rates_cache:
+                        rates_cache[key] = currency._get_cached_conversion_rate(currency, company_currency, company, date)
+                    rate = rates_cache[key]
+                balance = company_currency.round(price_subtotal * rate)
+                res.append({
+                    'amount_currency': price_subtotal,
+                    'debit': balance > 0.0 and balance or 0.0,
+                    'credit': balance < 0.0 and -balance or 0.0,
+                })
+            else:
+                # Single-currency.
+                res.append({
+                    'amount_currency': 0.0,
+                    'debit': price_subtotal > 0.0 and price_subtotal or 0.0,
+                    'credit': price_subtotal < 0.0 and -price_subtotal or 0.0,
+                })
+        return res
 